@@ -7,12 +7,21 @@ Built by Kluzo 😎 for JSK Labs
 """
 
 import streamlit as st
-import re
 import io
+import hashlib
+import time
 import zipfile
-from collections import defaultdict
 from datetime import datetime
-from pypdf import PdfReader, PdfWriter
+from itertools import groupby
+from operator import itemgetter
+from pypdf import PdfReader
+
+import label_sorter
+
+try:
+    import pymupdf as fitz  # PyMuPDF - much faster text extraction than pypdf
+except ImportError:
+    fitz = None
 
 st.set_page_config(
     page_title="Label Sorter | JSK Labs",
@@ -22,121 +31,126 @@ st.set_page_config(
 
 # --- Helper Functions ---
 
-def normalize_courier(courier_raw: str) -> str:
-    """Normalize courier names for consistent file naming."""
-    courier_lower = courier_raw.lower()
-    
-    if 'ekart' in courier_lower:
-        return 'Ekart'
-    elif 'delhivery' in courier_lower:
-        return 'Delhivery'
-    elif 'xpressbees' in courier_lower:
-        return 'Xpressbees'
-    elif 'bluedart' in courier_lower:
-        return 'BlueDart'
-    elif 'dtdc' in courier_lower:
-        return 'DTDC'
-    elif 'shadowfax' in courier_lower:
-        return 'Shadowfax'
-    elif 'ecom' in courier_lower:
-        return 'EcomExpress'
-    else:
-        return re.sub(r'[^\w\-]', '', courier_raw.replace(' ', '-'))[:30]
-
-
-def normalize_sku(sku_raw: str) -> str:
-    """Normalize SKU for filename safety."""
-    return re.sub(r'[^\w\-]', '', sku_raw.replace(' ', '-'))[:50]
-
-
-def extract_label_info(page_text: str) -> dict:
-    """Extract courier, SKU, and date from label text."""
-    info = {
-        'courier': 'Unknown',
-        'sku': 'Unknown',
-        'date': datetime.now().strftime('%Y-%m-%d')
-    }
-    
-    courier_patterns = [
-        (r'Ekart[^\n]*', 'Ekart'),
-        (r'Delhivery[^\n]*', 'Delhivery'),
-        (r'Xpressbees[^\n]*', 'Xpressbees'),
-        (r'BlueDart[^\n]*', 'BlueDart'),
-        (r'DTDC[^\n]*', 'DTDC'),
-        (r'Shadowfax[^\n]*', 'Shadowfax'),
-        (r'Ecom\s*Express[^\n]*', 'EcomExpress'),
-    ]
+# Minimum seconds between time-based progress bar refreshes
+PROGRESS_INTERVAL = 0.1
+
+# Analyses of recent uploads kept per browser session
+ANALYSIS_CACHE_SIZE = 8
+
+
+def open_pdf(pdf_bytes: bytes):
+    """Open uploaded PDF with PyMuPDF, falling back to pypdf."""
+    if fitz is not None:
+        return fitz.open(stream=pdf_bytes, filetype='pdf')
+    return PdfReader(io.BytesIO(pdf_bytes))
+
+
+def analyze_labels(pdf_bytes: bytes, progress=None) -> tuple:
+    """
+    Parse every label and group page indices by (date, courier, sku).
     
-    for pattern, name in courier_patterns:
-        match = re.search(pattern, page_text, re.IGNORECASE)
-        if match:
-            info['courier'] = name
-            break
+    `progress` is an optional callback(done, total).
     
-    sku_match = re.search(r'SKU:\s*([^\n]+)', page_text)
-    if sku_match:
-        info['sku'] = normalize_sku(sku_match.group(1).strip())
+    Returns:
+        ([((date, courier, sku), page_indices), ...] in sorted order, total_pages)
+    """
+    doc = open_pdf(pdf_bytes)
+    total_pages = len(doc) if fitz is not None else len(doc.pages)
     
-    date_match = re.search(r'Invoice Date:\s*(\d{4}-\d{2}-\d{2})', page_text)
-    if date_match:
-        info['date'] = date_match.group(1)
-    else:
-        date_match = re.search(r'(\d{4}-\d{2}-\d{2})', page_text)
-        if date_match:
-            info['date'] = date_match.group(1)
+    # (label info, page index) per page - sorted and grouped afterwards
+    entries = []
     
-    return info
-
-
-def sort_labels(pdf_file) -> tuple:
-    """Sort labels and return zip buffer with results."""
-    reader = PdfReader(pdf_file)
-    total_pages = len(reader.pages)
+    # Each progress update is a websocket message - refresh every ~1%
+    # of pages, or when the bar has been idle for PROGRESS_INTERVAL
+    progress_step = max(1, total_pages // 100)
+    last_update = time.monotonic()
     
-    # Group pages by (date, courier, sku)
-    groups = defaultdict(list)
+    for i, info in enumerate(label_sorter.iter_label_infos(pdf_bytes, doc, total_pages)):
+        entries.append((info, i))
+        
+        now = time.monotonic()
+        if progress and ((i + 1) % progress_step == 0 or now - last_update > PROGRESS_INTERVAL):
+            progress(i + 1, total_pages)
+            last_update = now
     
-    progress_bar = st.progress(0, text="Analyzing labels...")
+    # Stable sort keeps pages in original order within each group
+    entries.sort(key=itemgetter(0))
     
-    for i, page in enumerate(reader.pages):
-        text = page.extract_text() or ''
-        info = extract_label_info(text)
-        key = (info['date'], info['courier'], info['sku'])
-        groups[key].append(i)
-        progress_bar.progress((i + 1) / total_pages, text=f"Analyzing label {i+1}/{total_pages}")
-    
-    progress_bar.progress(1.0, text="Creating sorted PDFs...")
+    groups = [
+        (info, [idx for _, idx in group])
+        for info, group in groupby(entries, key=itemgetter(0))
+    ]
     
-    # Create zip with all sorted PDFs
+    return groups, total_pages
+
+
+def output_filename(date: str, courier: str, sku: str) -> str:
+    """Output filename: YYYY-MM-DD_Courier_SKU.pdf"""
+    return f"{date}_{courier}_{sku}.pdf"
+
+
+def build_zip(pdf_bytes: bytes, groups: list) -> io.BytesIO:
+    """Build a zip with one sorted PDF per (date, courier, sku) group."""
+    doc = open_pdf(pdf_bytes)
     zip_buffer = io.BytesIO()
-    results = []
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for (date, courier, sku), page_indices in sorted(groups.items()):
-            filename = f"{date}_{courier}_{sku}.pdf"
-            
-            writer = PdfWriter()
-            for idx in page_indices:
-                writer.add_page(reader.pages[idx])
-            
-            pdf_buffer = io.BytesIO()
-            writer.write(pdf_buffer)
-            pdf_buffer.seek(0)
-            
-            zf.writestr(filename, pdf_buffer.getvalue())
-            
-            results.append({
-                'file': filename,
-                'date': date,
-                'courier': courier,
-                'sku': sku,
-                'labels': len(page_indices)
-            })
+    
+    # PDFs are already compressed internally - deflating again wastes CPU
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zf:
+        for (date, courier, sku), page_indices in groups:
+            # Stream each PDF straight into its zip entry
+            with zf.open(output_filename(date, courier, sku), 'w', force_zip64=True) as entry:
+                label_sorter.write_group_pdf(doc, page_indices, entry)
     
     zip_buffer.seek(0)
-    progress_bar.empty()
+    return zip_buffer
+
+
+def sort_labels(pdf_file) -> tuple:
+    """
+    Analyze labels and return a zip builder with results.
+    
+    The zip is only built when the returned callable is invoked, so the
+    summary can be shown as soon as analysis finishes.
+    """
+    pdf_bytes = pdf_file.getvalue()
+    
+    # Reruns (e.g. clicking "Sort Labels" again) reuse the analysis of the
+    # same upload. A plain session_state dict rather than st.cache_data:
+    # the progress bar is created outside the analysis, which cache_data
+    # can't replay on a hit.
+    analyses = st.session_state.setdefault('label_analyses', {})
+    key = hashlib.sha256(pdf_bytes).digest()
+    
+    if key in analyses:
+        # Move to the end - the oldest analysis is evicted first
+        analyses[key] = analyses.pop(key)
+    else:
+        progress_bar = st.progress(0, text="Analyzing labels...")
+        analyses[key] = analyze_labels(
+            pdf_bytes,
+            progress=lambda done, total: progress_bar.progress(
+                done / total, text=f"Analyzing label {done}/{total}"
+            )
+        )
+        progress_bar.empty()
+        
+        while len(analyses) > ANALYSIS_CACHE_SIZE:
+            del analyses[next(iter(analyses))]
+    
+    groups, total_pages = analyses[key]
+    
+    results = [
+        {
+            'file': output_filename(date, courier, sku),
+            'date': date,
+            'courier': courier,
+            'sku': sku,
+            'labels': len(page_indices)
+        }
+        for (date, courier, sku), page_indices in groups
+    ]
     
-    return zip_buffer, results, total_pages
+    return (lambda: build_zip(pdf_bytes, groups)), results, total_pages
 
 
 # --- UI ---
@@ -158,7 +172,7 @@ if uploaded_file:
     if st.button("🚀 Sort Labels", type="primary", use_container_width=True):
         with st.spinner("Processing..."):
             try:
-                zip_buffer, results, total_pages = sort_labels(uploaded_file)
+                build_zip_buffer, results, total_pages = sort_labels(uploaded_file)
                 
                 st.success(f"✅ Sorted **{total_pages} labels** into **{len(results)} files**")
                 
@@ -176,10 +190,11 @@ if uploaded_file:
                 
                 st.divider()
                 
-                # Download button
+                # Download button - zip is built on click, without a rerun
                 st.download_button(
                     label="📥 Download All (ZIP)",
-                    data=zip_buffer,
+                    data=build_zip_buffer,
+                    on_click="ignore",
                     file_name=f"sorted_labels_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
                     mime="application/zip",
                     type="primary",
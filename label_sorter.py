@@ -9,18 +9,73 @@ Output format: YYYY-MM-DD_Courier_SKU.pdf
 Author: Kluzo 😎 for Dhruv Shetty / JSK Labs
 """
 
+import io
 import re
+import multiprocessing
 import os
 import sys
 from pathlib import Path
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from typing import NamedTuple, Tuple
 
-# Add venv packages
-sys.path.insert(0, '/Users/klaus/.openclaw/workspace/.venv/lib/python3.13/site-packages')
+# Add venv packages - only when run as the CLI, so importers such as the
+# web app keep their own sys.path
+if __name__ == '__main__':
+    sys.path.insert(0, '/Users/klaus/.openclaw/workspace/.venv/lib/python3.13/site-packages')
 
 from pypdf import PdfReader, PdfWriter
 
+try:
+    import pymupdf as fitz  # PyMuPDF - C-backed, much faster than pypdf
+except ImportError:
+    fitz = None
+
+# Lowercased keyword -> canonical name (order matters - first hit wins).
+# Plain substring checks replaced an IGNORECASE alternation regex (with an
+# re.ASCII variant for ASCII text): even the ASCII regex cost ~30 us per
+# page against well under 1 us for lower() plus 'in'.
+_COURIER_MAP = {
+    'ekart': 'Ekart',
+    'delhivery': 'Delhivery',
+    'xpressbees': 'Xpressbees',
+    'bluedart': 'BlueDart',
+    'dtdc': 'DTDC',
+    'shadowfax': 'Shadowfax',
+}
+# "Ecom Express" may be split by any whitespace, so it needs a regex
+_ECOM_EXPRESS_RE = re.compile(r'ecom\s*express')
+# Canonical courier name -> text to locate on the page (calibrate_header)
+_COURIER_SEARCH = {name: keyword for keyword, name in _COURIER_MAP.items()}
+_COURIER_SEARCH['EcomExpress'] = 'ecom'
+_SKU_RE = re.compile(r'SKU:\s*([^\n]+)')
+_DATE_INV_RE = re.compile(r'Invoice Date:\s*(\d{4}-\d{2}-\d{2})')
+_DATE_ANY_RE = re.compile(r'(\d{4}-\d{2}-\d{2})')
+# Anything not safe in a filename
+_CLEAN_RE = re.compile(r'[^\w\-]')
+
+# Threads used to write output PDFs to disk
+WRITE_WORKERS = 4
+
+# Courier, SKU and invoice date sit in the top of a Shiprocket label
+HEADER_CLIP_FRACTION = 0.4
+
+# Below this many pages, a process pool costs more than it saves
+PARALLEL_MIN_PAGES = 200
+# Contiguous page ranges handed to each pool worker per run - enough to
+# even out the load, few enough to keep task round-trips negligible
+POOL_TASKS_PER_WORKER = 4
+
+# Per-process document used by extract_page_info() in pool workers
+_worker_doc = None
+_worker_use_fitz = False
+_worker_today = None
+_worker_header_clips = None
+
 
 def normalize_courier(courier_raw: str) -> str:
     """Normalize courier names for consistent file naming."""
@@ -42,65 +97,279 @@ def normalize_courier(courier_raw: str) -> str:
         return 'EcomExpress'
     else:
         # Clean up for filename
-        return re.sub(r'[^\w\-]', '', courier_raw.replace(' ', '-'))[:30]
+        return _CLEAN_RE.sub('', courier_raw.replace(' ', '-'))[:30]
 
 
+# The same few SKUs repeat across hundreds of labels
+@lru_cache(maxsize=512)
 def normalize_sku(sku_raw: str) -> str:
     """Normalize SKU for filename safety."""
     # Remove special chars, keep alphanumeric and hyphens
-    return re.sub(r'[^\w\-]', '', sku_raw.replace(' ', '-'))[:50]
+    return _CLEAN_RE.sub('', sku_raw.replace(' ', '-'))[:50]
 
 
-def extract_label_info(page_text: str) -> dict:
-    """Extract courier, SKU, and date from label text."""
-    info = {
-        'courier': 'Unknown',
-        'sku': 'Unknown',
-        'date': datetime.now().strftime('%Y-%m-%d')
-    }
+class LabelInfo(NamedTuple):
+    """Fields parsed from one label, in grouping-key order."""
+    date: str
+    courier: str
+    sku: str
+
+
+def extract_label_info(page_text: str, today: str = None) -> LabelInfo:
+    """Extract courier, SKU, and date from label text.
     
-    # Courier patterns (order matters - more specific first)
-    courier_patterns = [
-        (r'Ekart[^\n]*', 'Ekart'),
-        (r'Delhivery[^\n]*', 'Delhivery'),
-        (r'Xpressbees[^\n]*', 'Xpressbees'),
-        (r'BlueDart[^\n]*', 'BlueDart'),
-        (r'DTDC[^\n]*', 'DTDC'),
-        (r'Shadowfax[^\n]*', 'Shadowfax'),
-        (r'Ecom\s*Express[^\n]*', 'EcomExpress'),
-    ]
+    `today` is the fallback date (YYYY-MM-DD) when the label has none;
+    callers parsing many pages should compute it once and pass it in.
+    """
+    return parse_label(page_text, today)[0]
+
+
+def parse_label(page_text: str, today: str = None) -> Tuple[LabelInfo, bool]:
+    """
+    Extract label info as extract_label_info() does.
+    
+    Also returns whether the date came from an "Invoice Date:" field,
+    so has_label_fields() needs no second scan of the text.
+    """
+    courier = 'Unknown'
+    sku = 'Unknown'
+    date = today or datetime.now().strftime('%Y-%m-%d')
     
-    for pattern, name in courier_patterns:
-        match = re.search(pattern, page_text, re.IGNORECASE)
-        if match:
-            info['courier'] = name
+    # Substring checks on the lowercased text are far cheaper than a
+    # case-insensitive regex scan
+    text_lower = page_text.lower()
+    for keyword, name in _COURIER_MAP.items():
+        if keyword in text_lower:
+            courier = name
             break
+    else:
+        if 'ecom' in text_lower and _ECOM_EXPRESS_RE.search(text_lower):
+            courier = 'EcomExpress'
     
-    # SKU extraction
-    sku_match = re.search(r'SKU:\s*([^\n]+)', page_text)
-    if sku_match:
-        info['sku'] = normalize_sku(sku_match.group(1).strip())
+    # SKU extraction (str.find skips the regex on pages without a SKU).
+    # Interned so repeated SKUs/dates share one string object across pages
+    pos = page_text.find('SKU:')
+    if pos >= 0:
+        sku_match = _SKU_RE.search(page_text, pos)
+        if sku_match:
+            sku = sys.intern(normalize_sku(sku_match.group(1).strip()))
     
-    # Date extraction (Invoice Date preferred)
-    date_match = re.search(r'Invoice Date:\s*(\d{4}-\d{2}-\d{2})', page_text)
-    if date_match:
-        info['date'] = date_match.group(1)
+    # Date extraction (Invoice Date preferred). The str.find gate means only
+    # one regex scans the page in practice; folding both into a single
+    # alternation regex measured ~3x slower, as it defeats the regex
+    # engine's literal-prefix search.
+    pos = page_text.find('Invoice Date:')
+    date_match = _DATE_INV_RE.search(page_text, pos) if pos >= 0 else None
+    invoice_dated = date_match is not None
+    if invoice_dated:
+        date = sys.intern(date_match.group(1))
     else:
         # Try other date formats
-        date_match = re.search(r'(\d{4}-\d{2}-\d{2})', page_text)
+        date_match = _DATE_ANY_RE.search(page_text)
         if date_match:
-            info['date'] = date_match.group(1)
+            date = sys.intern(date_match.group(1))
     
-    return info
+    return LabelInfo(date, courier, sku), invoice_dated
 
 
-def sort_labels(input_pdf: str, output_dir: str = None) -> dict:
+def calibrate_header(page, info: LabelInfo) -> float:
+    """
+    Find how far down the page the courier, SKU and invoice date end.
+    
+    info is the page's label info, parsed from its full text. Returns
+    the clip height for this label format, or 0 if a field can't be
+    located on the page.
+    """
+    bottom = 0
+    for field in (_COURIER_SEARCH[info.courier], 'SKU:', 'Invoice Date:'):
+        hits = page.search_for(field)
+        if not hits:
+            return 0
+        # The parse only needs the first occurrence; one extra line of
+        # slack for values that wrap
+        first = min(hits, key=lambda r: r.y0)
+        bottom = max(bottom, first.y1 + first.height)
+    return min(bottom, page.rect.height)
+
+
+def has_label_fields(info: LabelInfo, invoice_dated: bool) -> bool:
+    """Check a parse_label() result for courier, SKU and invoice date."""
+    return info.courier != 'Unknown' and info.sku != 'Unknown' and invoice_dated
+
+
+def get_annotation_text(page) -> str:
+    """Text carried by a PyMuPDF page's annotations and form fields."""
+    parts = [annot.info.get('content', '') for annot in page.annots()]
+    parts += [f"{widget.field_name}: {widget.field_value}" for widget in page.widgets()]
+    return '\n'.join(parts)
+
+
+def get_page_text(page, today: str = None,
+                  header_clips: dict = None) -> Tuple[str, LabelInfo]:
+    """
+    Extract text from a PyMuPDF page, along with its parsed label info.
+    
+    Fields carried in annotations or form fields are used without any
+    text extraction. Otherwise only the header band is extracted first;
+    the full page is read if courier, SKU or invoice date is missing
+    from it. Each text is parsed once, and callers reuse that result.
+    
+    header_clips maps page size to header band height for one document.
+    Whenever the band misses but the full page has all three fields,
+    the band for that size is recalibrated (grown) from the page.
+    """
+    if header_clips is None:
+        header_clips = {}
+    
+    # Most labels have neither, which costs a single check
+    if page.first_annot or page.first_widget:
+        fields = get_annotation_text(page)
+        info, invoice_dated = parse_label(fields, today)
+        if has_label_fields(info, invoice_dated):
+            return fields, info
+    
+    rect = page.rect
+    size = (round(rect.width), round(rect.height))
+    clip_height = header_clips.get(size, rect.height * HEADER_CLIP_FRACTION)
+    header = page.get_text(clip=fitz.Rect(0, 0, rect.width, clip_height))
+    info, invoice_dated = parse_label(header, today)
+    if has_label_fields(info, invoice_dated):
+        return header, info
+    
+    text = page.get_text()
+    info, invoice_dated = parse_label(text, today)
+    # Blank or malformed pages (fields missing from the full text too)
+    # say nothing about the band
+    if has_label_fields(info, invoice_dated):
+        calibrated = calibrate_header(page, info)
+        if calibrated > clip_height:
+            header_clips[size] = calibrated
+    return text, info
+
+
+def init_text_worker(pdf_source, use_pypdf: bool = False) -> None:
+    """
+    Open the PDF once per worker process (ProcessPoolExecutor initializer).
+    
+    pdf_source is either a file path or the raw PDF bytes.
+    """
+    global _worker_doc, _worker_use_fitz, _worker_today, _worker_header_clips
+    _worker_use_fitz = fitz is not None and not use_pypdf
+    _worker_today = datetime.now().strftime('%Y-%m-%d')
+    _worker_header_clips = {}
+    if isinstance(pdf_source, bytes):
+        if _worker_use_fitz:
+            _worker_doc = fitz.open(stream=pdf_source, filetype='pdf')
+        else:
+            _worker_doc = PdfReader(io.BytesIO(pdf_source))
+    elif _worker_use_fitz:
+        _worker_doc = fitz.open(pdf_source)
+    else:
+        _worker_doc = PdfReader(pdf_source)
+
+
+def extract_page_info(page_index: int) -> LabelInfo:
+    """Extract label info of one page from the worker's document."""
+    if _worker_use_fitz:
+        return get_page_text(_worker_doc[page_index], _worker_today,
+                             _worker_header_clips)[1]
+    text = _worker_doc.pages[page_index].extract_text() or ''
+    return extract_label_info(text, _worker_today)
+
+
+def pool_chunksize(total_pages: int, workers: int) -> int:
+    """Pages per process-pool task, so each worker gets a few large page ranges."""
+    return max(16, -(-total_pages // (workers * POOL_TASKS_PER_WORKER)))
+
+
+def iter_label_infos(pdf_source, doc, total_pages: int, use_pypdf: bool = False):
+    """
+    Yield label info for every page, in page order.
+    
+    pdf_source is the PDF's path or bytes and doc the already open
+    document: a PyMuPDF Document, or a PdfReader when use_pypdf is set
+    or PyMuPDF isn't installed. Large PDFs are parsed across a process
+    pool; small ones aren't worth the worker start-up cost.
+    """
+    workers = os.cpu_count() or 1
+    if workers > 1 and total_pages >= PARALLEL_MIN_PAGES:
+        # Spawn, not fork: the Streamlit app calls this from a
+        # multi-threaded server, and forking it can deadlock on locks
+        # held by other threads
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_text_worker,
+                                 initargs=(pdf_source, use_pypdf)) as pool:
+            yield from pool.map(extract_page_info, range(total_pages),
+                                chunksize=pool_chunksize(total_pages, workers))
+        return
+    
+    today = datetime.now().strftime('%Y-%m-%d')
+    if fitz is not None and not use_pypdf:
+        # Header band heights are learned per document
+        header_clips = {}
+        for page in doc:
+            yield get_page_text(page, today, header_clips)[1]
+    else:
+        for page in doc.pages:
+            yield extract_label_info(page.extract_text() or '', today)
+
+
+def write_group_pdf(doc, page_indices: list, dest) -> None:
+    """
+    Write a PDF containing only the given pages of the document.
+    
+    doc is a PyMuPDF Document or a pypdf PdfReader; dest is a file path or
+    a binary file object (e.g. a zip entry).
+    """
+    to_path = isinstance(dest, (str, Path))
+    
+    if not isinstance(doc, PdfReader):
+        out = fitz.open()
+        # Insert consecutive runs of pages in one call each. final=False
+        # keeps the graft map between calls so fonts/images shared by the
+        # source pages are copied once, not once per run.
+        start = prev = page_indices[0]
+        for idx in list(page_indices[1:]) + [None]:
+            if idx != prev + 1:
+                out.insert_pdf(doc, from_page=start, to_page=prev, final=idx is None)
+                start = idx
+            prev = idx
+        # save() to a path uses MuPDF's own file I/O - far faster than
+        # tobytes() or a Python stream on large outputs
+        if to_path:
+            out.save(str(dest))
+        else:
+            dest.write(out.tobytes())
+        out.close()
+        return
+    
+    # One batched append instead of resolving and copying page by page
+    writer = PdfWriter()
+    writer.append(doc, pages=list(page_indices), import_outline=False)
+    # Labels carry their own copy of the same fonts and logos; merging
+    # identical objects shrinks the output several-fold and serializing
+    # less more than pays for the pass
+    writer.compress_identical_objects()
+    
+    if to_path or dest.seekable():
+        writer.write(str(dest) if to_path else dest)
+    else:
+        # pypdf needs a seekable stream (it records xref offsets via tell()),
+        # which zip entries are not - stage through a per-group buffer
+        pdf_buffer = io.BytesIO()
+        writer.write(pdf_buffer)
+        dest.write(pdf_buffer.getbuffer())
+
+
+def sort_labels(input_pdf: str, output_dir: str = None, use_pypdf: bool = False) -> dict:
     """
     Sort labels from input PDF into separate PDFs by Courier + SKU.
     
     Args:
         input_pdf: Path to the input PDF with bulk labels
         output_dir: Directory for output PDFs (default: same as input)
+        use_pypdf: Extract text with pypdf instead of PyMuPDF (for PDFs PyMuPDF mis-reads)
     
     Returns:
         dict with summary of created files
@@ -117,50 +386,80 @@ def sort_labels(input_pdf: str, output_dir: str = None) -> dict:
     
     output_dir.mkdir(parents=True, exist_ok=True)
     
+    use_fitz = fitz is not None and not use_pypdf
+    
     print(f"📄 Reading: {input_path.name}")
-    reader = PdfReader(str(input_path))
-    total_pages = len(reader.pages)
+    # use_pypdf only switches text extraction - output PDFs are always
+    # assembled with PyMuPDF's C writer when it is installed
+    doc = fitz.open(str(input_path)) if fitz is not None else None
+    if use_fitz:
+        total_pages = len(doc)
+    else:
+        reader = PdfReader(str(input_path))
+        total_pages = len(reader.pages)
     print(f"   Found {total_pages} labels")
     
-    # Group pages by (date, courier, sku)
-    groups = defaultdict(list)
+    # (label info, page index) per page - sorted and grouped afterwards
+    entries = []
     
-    for i, page in enumerate(reader.pages):
-        text = page.extract_text() or ''
-        info = extract_label_info(text)
-        
-        key = (info['date'], info['courier'], info['sku'])
-        groups[key].append(i)
+    page_infos = iter_label_infos(str(input_path), doc if use_fitz else reader,
+                                  total_pages, use_pypdf)
+    for i, info in enumerate(page_infos):
+        entries.append((info, i))
         
         if (i + 1) % 50 == 0:
             print(f"   Processed {i + 1}/{total_pages} labels...")
     
+    # Stable sort keeps pages in original order within each group
+    entries.sort(key=itemgetter(0))
+    groups = [
+        (key, [idx for _, idx in group])
+        for key, group in groupby(entries, key=itemgetter(0))
+    ]
+    
     print(f"\n📦 Found {len(groups)} unique groups")
     
     # Create output PDFs
     results = []
     
-    for (date, courier, sku), page_indices in sorted(groups.items()):
-        # Output filename: YYYY-MM-DD_Courier_SKU.pdf
-        filename = f"{date}_{courier}_{sku}.pdf"
-        output_path = output_dir / filename
+    # pypdf output is written on a thread pool so disk I/O overlaps with
+    # building the next group (PyMuPDF saves natively, straight to the
+    # file). Building stays on this thread: neither a PdfReader nor a
+    # PyMuPDF document is safe to share between threads.
+    write_pool = ThreadPoolExecutor(max_workers=WRITE_WORKERS) if doc is None else nullcontext()
+    with write_pool:
+        pending_writes = []
         
-        writer = PdfWriter()
-        for idx in page_indices:
-            writer.add_page(reader.pages[idx])
+        for (date, courier, sku), page_indices in groups:
+            # Output filename: YYYY-MM-DD_Courier_SKU.pdf
+            filename = f"{date}_{courier}_{sku}.pdf"
+            output_path = output_dir / filename
+            
+            if doc is not None:
+                write_group_pdf(doc, page_indices, output_path)
+            else:
+                # Serialize in memory, then write the file in one call
+                pdf_buffer = io.BytesIO()
+                write_group_pdf(reader, page_indices, pdf_buffer)
+                pending_writes.append(
+                    write_pool.submit(output_path.write_bytes, pdf_buffer.getbuffer())
+                )
+            
+            result = {
+                'file': filename,
+                'date': date,
+                'courier': courier,
+                'sku': sku,
+                'labels': len(page_indices)
+            }
+            results.append(result)
         
-        with open(output_path, 'wb') as f:
-            writer.write(f)
-        
-        result = {
-            'file': filename,
-            'date': date,
-            'courier': courier,
-            'sku': sku,
-            'labels': len(page_indices)
-        }
-        results.append(result)
-        print(f"   ✅ {filename} ({len(page_indices)} labels)")
+        # Surface any write errors
+        for future in pending_writes:
+            future.result()
+    
+    # One write for the whole listing, and only once every file is on disk
+    print('\n'.join(f"   ✅ {r['file']} ({r['labels']} labels)" for r in results))
     
     print(f"\n🎉 Done! {len(results)} files created in: {output_dir}")
     
@@ -181,11 +480,13 @@ def main():
     )
     parser.add_argument('input_pdf', help='Path to input PDF with bulk labels')
     parser.add_argument('-o', '--output', help='Output directory (default: ./sorted_labels)')
+    parser.add_argument('--pypdf', action='store_true',
+                        help='Extract text with pypdf instead of PyMuPDF (slower, for PDFs PyMuPDF mis-reads)')
     
     args = parser.parse_args()
     
     try:
-        result = sort_labels(args.input_pdf, args.output)
+        result = sort_labels(args.input_pdf, args.output, use_pypdf=args.pypdf)
         
         print("\n" + "="*50)
         print("SUMMARY")
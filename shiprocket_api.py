@@ -4,26 +4,145 @@ Handles authentication, order management, shipping, and label downloads.
 """
 
 import os
+import json
+import hashlib
+import hmac
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from pathlib import Path
 from typing import Optional, Dict, List, Any
 import time
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Chunk size for streamed label PDF downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Times a rate-limited (HTTP 429) AWB assignment is retried
+RATE_LIMIT_RETRIES = 3
+
+# Opt-in (cache_token=True) auth tokens saved between runs, one file per
+# account, so each CLI invocation doesn't log in again
+TOKEN_CACHE_DIR = Path.home() / ".shiprocket"
+# Random per-install salt for the credential hashes in the token files
+TOKEN_CACHE_SALT_PATH = TOKEN_CACHE_DIR / "salt"
+# PBKDF2 rounds for the hash that ties a cached token to email + password
+TOKEN_CACHE_HASH_ITERATIONS = 100_000
+
+
+def _create_session() -> requests.Session:
+    """Create a pooled, keep-alive session for a client's API calls."""
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # Hand the last response back so raise_for_status() raises HTTPError
+        # as before, instead of urllib3 raising RetryError with no response
+        raise_on_status=False
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry))
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+def _read_cache_salt() -> Optional[bytes]:
+    """Read the token cache salt, creating it (owner read/write only) on first use."""
+    try:
+        TOKEN_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        try:
+            fd = os.open(TOKEN_CACHE_SALT_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return TOKEN_CACHE_SALT_PATH.read_bytes() or None
+        salt = os.urandom(16)
+        with os.fdopen(fd, "wb") as f:
+            f.write(salt)
+        return salt
+    except OSError:
+        return None
+
+
+def _retry_after(response: requests.Response, attempt: int) -> float:
+    """Seconds to wait before retrying a 429: Retry-After, else exponential backoff."""
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return 0.5 * 2 ** attempt
+
 
 class ShiprocketAPI:
     """Shiprocket API client for order and shipping management."""
     
     BASE_URL = "https://apiv2.shiprocket.in/v1/external"
     
-    def __init__(self, email: str = None, password: str = None):
-        """Initialize with credentials from params or environment."""
+    def __init__(self, email: str = None, password: str = None, cache_token: bool = False):
+        """
+        Initialize with credentials from params or environment.
+        
+        With cache_token, the auth token is saved under TOKEN_CACHE_DIR and
+        reused by later clients with the same email and password.
+        """
         self.email = email or os.getenv("SHIPROCKET_EMAIL")
         self.password = password or os.getenv("SHIPROCKET_PASSWORD")
         self.token = None
         self.token_expiry = None
+        # Reuses TCP/TLS connections across calls instead of a new handshake each time
+        self._session = _create_session()
+        # Token read from the cache file, if any - the server may have revoked it
+        self._cached_token = None
+        self._auth_lock = threading.Lock()
         
         if not self.email or not self.password:
             raise ValueError("Shiprocket credentials not provided. Set SHIPROCKET_EMAIL and SHIPROCKET_PASSWORD.")
+        
+        # Token cache file and credential hash (None when caching is off)
+        self._cache_path = None
+        self._credential_hash = None
+        if cache_token:
+            salt = _read_cache_salt()
+            if salt:
+                email = self.email.encode()
+                account = hashlib.sha256(salt + email).hexdigest()[:32]
+                self._cache_path = TOKEN_CACHE_DIR / f"token-{account}.json"
+                # The password itself is never written to disk
+                self._credential_hash = hashlib.pbkdf2_hmac(
+                    "sha256", self.password.encode(), salt + email,
+                    TOKEN_CACHE_HASH_ITERATIONS
+                ).hex()
+                self._load_cached_token()
+    
+    def _load_cached_token(self) -> None:
+        """Reuse a saved token if it is still valid and the credentials match."""
+        try:
+            cached = json.loads(self._cache_path.read_text())
+            if not hmac.compare_digest(cached["credentials"], self._credential_hash):
+                return
+            token_expiry = datetime.fromisoformat(cached["expiry"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        
+        self.token = self._cached_token = cached.get("token")
+        self.token_expiry = token_expiry
+    
+    def _save_cached_token(self) -> None:
+        """Save the token (owner read/write only) if caching; failures are ignored."""
+        if self._cache_path is None:
+            return
+        try:
+            fd = os.open(self._cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({
+                    "credentials": self._credential_hash,
+                    "token": self.token,
+                    "expiry": self.token_expiry.isoformat()
+                }, f)
+            os.chmod(self._cache_path, 0o600)
+        except OSError:
+            pass
     
     def _get_headers(self) -> Dict[str, str]:
         """Get headers with authentication token."""
@@ -35,6 +154,40 @@ class ShiprocketAPI:
             "Authorization": f"Bearer {self.token}"
         }
     
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send an authenticated API request, raising on HTTP errors.
+        
+        A 401 for a token loaded from disk (revoked by a password change or
+        a logout elsewhere) triggers one fresh login and a retry.
+        """
+        headers = self._get_headers()
+        token = self.token
+        response = self._session.request(method, url, headers=headers, **kwargs)
+        
+        if response.status_code == 401 and self._replace_cached_token(token):
+            response = self._session.request(method, url, headers=self._get_headers(), **kwargs)
+        
+        response.raise_for_status()
+        return response
+    
+    def _replace_cached_token(self, rejected_token: str) -> bool:
+        """
+        Log in again if rejected_token is the token loaded from disk.
+        
+        Returns True if the request should be retried with the new token.
+        """
+        if rejected_token is None or rejected_token != self._cached_token:
+            return False
+        
+        # Concurrent requests (bulk_ship_orders) may all see the 401;
+        # only the first one logs in
+        with self._auth_lock:
+            if self.token == rejected_token:
+                self.token = None
+                self.authenticate()
+        return True
+    
     def _is_token_expired(self) -> bool:
         """Check if token is expired (with 1 hour buffer)."""
         if not self.token_expiry:
@@ -49,13 +202,14 @@ class ShiprocketAPI:
             "password": self.password
         }
         
-        response = requests.post(url, json=payload)
+        response = self._session.post(url, json=payload)
         response.raise_for_status()
         data = response.json()
         
         self.token = data.get("token")
         # Token valid for 10 days, set expiry with buffer
         self.token_expiry = datetime.now() + timedelta(days=9)
+        self._save_cached_token()
         
         return data
     
@@ -86,24 +240,21 @@ class ShiprocketAPI:
             "to": to_date
         }
         
-        response = requests.get(url, headers=self._get_headers(), params=params)
-        response.raise_for_status()
+        response = self._request("GET", url, params=params)
         return response.json()
     
     def get_order_details(self, order_id: int) -> Dict[str, Any]:
         """Get detailed information about a specific order."""
         url = f"{self.BASE_URL}/orders/show/{order_id}"
         
-        response = requests.get(url, headers=self._get_headers())
-        response.raise_for_status()
+        response = self._request("GET", url)
         return response.json()
     
     def get_shipment_details(self, shipment_id: int) -> Dict[str, Any]:
         """Get shipment details including AWB."""
         url = f"{self.BASE_URL}/shipments/{shipment_id}"
         
-        response = requests.get(url, headers=self._get_headers())
-        response.raise_for_status()
+        response = self._request("GET", url)
         return response.json()
     
     def assign_awb(self, shipment_id: int, courier_id: int = None) -> Dict[str, Any]:
@@ -123,40 +274,68 @@ class ShiprocketAPI:
         if courier_id:
             payload["courier_id"] = courier_id
         
-        response = requests.post(url, headers=self._get_headers(), json=payload)
-        response.raise_for_status()
+        response = self._request("POST", url, json=payload)
         return response.json()
     
-    def bulk_ship_orders(self, shipment_ids: List[int], delay: float = 0.5) -> List[Dict[str, Any]]:
+    def bulk_ship_orders(self, shipment_ids: List[int], delay: float = 0.1,
+                         max_workers: int = 8) -> List[Dict[str, Any]]:
         """
         Ship multiple orders using auto courier assignment.
         
+        Requests run concurrently so each call's network round-trip overlaps
+        with the others; new requests are still started at most once per
+        `delay` seconds (10 per second by default). Calls rejected with
+        HTTP 429 are retried after the server's Retry-After wait.
+        
         Args:
             shipment_ids: List of shipment IDs to ship
-            delay: Delay between API calls to avoid rate limiting
+            delay: Delay between starting API calls to avoid rate limiting
+            max_workers: Maximum number of requests in flight at once
         
         Returns:
-            List of results for each shipment
+            List of results for each shipment, in input order
         """
-        results = []
-        
-        for shipment_id in shipment_ids:
+        if not shipment_ids:
+            return []
+        
+        # Authenticate up front so worker threads don't race to log in
+        self._get_headers()
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            # Start times are scheduled from t0 so slow submits don't add drift
+            t0 = time.monotonic()
+            for i, shipment_id in enumerate(shipment_ids):
+                wait = t0 + i * delay - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                futures.append(executor.submit(self._ship_one, shipment_id))
+            
+            return [future.result() for future in futures]
+    
+    def _ship_one(self, shipment_id: int) -> Dict[str, Any]:
+        """Assign AWB to one shipment, capturing request errors in the result."""
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
             try:
                 result = self.assign_awb(shipment_id)
                 result["shipment_id"] = shipment_id
                 result["success"] = result.get("awb_assign_status") == 1
-                results.append(result)
+                return result
+            except requests.exceptions.HTTPError as e:
+                # A 429 was rejected before processing, so retrying is safe
+                if e.response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                    error = e
+                    break
+                time.sleep(_retry_after(e.response, attempt))
             except requests.exceptions.RequestException as e:
-                results.append({
-                    "shipment_id": shipment_id,
-                    "success": False,
-                    "error": str(e)
-                })
-            
-            if delay > 0:
-                time.sleep(delay)
+                error = e
+                break
         
-        return results
+        return {
+            "shipment_id": shipment_id,
+            "success": False,
+            "error": str(error)
+        }
     
     def get_available_couriers(self, 
                                pickup_postcode: str, 
@@ -176,8 +355,7 @@ class ShiprocketAPI:
         if order_id:
             params["order_id"] = order_id
         
-        response = requests.get(url, headers=self._get_headers(), params=params)
-        response.raise_for_status()
+        response = self._request("GET", url, params=params)
         return response.json()
     
     def generate_label(self, shipment_ids: List[int]) -> bytes:
@@ -193,23 +371,62 @@ class ShiprocketAPI:
         url = f"{self.BASE_URL}/courier/generate/label"
         payload = {"shipment_id": shipment_ids}
         
-        response = requests.post(url, headers=self._get_headers(), json=payload)
-        response.raise_for_status()
+        response = self._request("POST", url, json=payload)
         
         data = response.json()
         
         # The API returns a URL to the label PDF
         if "label_url" in data:
-            label_response = requests.get(data["label_url"])
+            label_response = self._session.get(data["label_url"])
             label_response.raise_for_status()
             return label_response.content
         elif "label_created" in data and data.get("label_url"):
-            label_response = requests.get(data["label_url"])
+            label_response = self._session.get(data["label_url"])
             label_response.raise_for_status()
             return label_response.content
         
         return data
     
+    def generate_label_to_file(self, shipment_ids: List[int], path: str) -> bool:
+        """
+        Generate shipping labels and stream the PDF straight to a file.
+        
+        Unlike generate_label, the PDF is never held in memory in full.
+        
+        Args:
+            shipment_ids: List of shipment IDs (max 50)
+            path: File to write the label PDF to
+        
+        Returns:
+            True if a label PDF was written, False if the API returned no label URL
+        """
+        label_url = self.get_label_url(shipment_ids)
+        if not label_url:
+            return False
+        
+        self._download_file(label_url, path)
+        return True
+    
+    def _download_file(self, url: str, path: str) -> None:
+        """
+        Stream a download to disk in DOWNLOAD_CHUNK_SIZE pieces.
+        
+        Data goes to `path`.part, renamed into place only once
+        complete, so a dropped connection never leaves a truncated PDF.
+        """
+        with self._session.get(url, stream=True) as response:
+            response.raise_for_status()
+            tmp_path = f"{path}.part"
+            try:
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+    
     def get_label_url(self, shipment_ids: List[int]) -> str:
         """
         Get label PDF URL for shipments.
@@ -223,8 +440,7 @@ class ShiprocketAPI:
         url = f"{self.BASE_URL}/courier/generate/label"
         payload = {"shipment_id": shipment_ids}
         
-        response = requests.post(url, headers=self._get_headers(), json=payload)
-        response.raise_for_status()
+        response = self._request("POST", url, json=payload)
         
         data = response.json()
         return data.get("label_url", "")
@@ -234,8 +450,7 @@ class ShiprocketAPI:
         url = f"{self.BASE_URL}/manifests/generate"
         payload = {"shipment_id": shipment_ids}
         
-        response = requests.post(url, headers=self._get_headers(), json=payload)
-        response.raise_for_status()
+        response = self._request("POST", url, json=payload)
         return response.json()
     
     def request_pickup(self, shipment_ids: List[int], pickup_date: str = None) -> Dict[str, Any]:
@@ -259,8 +474,7 @@ class ShiprocketAPI:
             "pickup_date": pickup_date
         }
         
-        response = requests.post(url, headers=self._get_headers(), json=payload)
-        response.raise_for_status()
+        response = self._request("POST", url, json=payload)
         return response.json()
     
     def get_tracking(self, awb: str = None, shipment_id: int = None, order_id: int = None) -> Dict[str, Any]:
@@ -284,8 +498,7 @@ class ShiprocketAPI:
         else:
             raise ValueError("Provide either awb, shipment_id, or order_id")
         
-        response = requests.get(url, headers=self._get_headers())
-        response.raise_for_status()
+        response = self._request("GET", url)
         return response.json()
     
     def cancel_shipment(self, awb_codes: List[str]) -> Dict[str, Any]:
@@ -293,19 +506,31 @@ class ShiprocketAPI:
         url = f"{self.BASE_URL}/orders/cancel/shipment/awbs"
         payload = {"awbs": awb_codes}
         
-        response = requests.post(url, headers=self._get_headers(), json=payload)
-        response.raise_for_status()
+        response = self._request("POST", url, json=payload)
         return response.json()
     
     def get_wallet_balance(self) -> Dict[str, Any]:
         """Get current wallet balance."""
         url = f"{self.BASE_URL}/account/details/wallet-balance"
         
-        response = requests.get(url, headers=self._get_headers())
-        response.raise_for_status()
+        response = self._request("GET", url)
         return response.json()
 
 
+def get_order_shipments(order: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Get an order's shipments as a list.
+    
+    The orders API returns `shipments` as either a single dict or a list.
+    """
+    shipments = order.get("shipments")
+    if not shipments:
+        return []
+    if isinstance(shipments, dict):
+        return [shipments]
+    return shipments
+
+
 # Convenience functions for quick operations
 def quick_ship_new_orders(email: str = None, password: str = None, limit: int = 50) -> Dict[str, Any]:
     """
@@ -323,14 +548,11 @@ def quick_ship_new_orders(email: str = None, password: str = None, limit: int =
         return {"message": "No new orders to ship", "shipped": 0}
     
     # Extract shipment IDs
-    shipment_ids = []
-    for order in orders:
-        if "shipments" in order and order["shipments"]:
-            if isinstance(order["shipments"], list):
-                for shipment in order["shipments"]:
-                    shipment_ids.append(shipment["id"])
-            elif isinstance(order["shipments"], dict):
-                shipment_ids.append(order["shipments"]["id"])
+    shipment_ids = [
+        shipment["id"]
+        for order in orders
+        for shipment in get_order_shipments(order)
+    ]
     
     if not shipment_ids:
         return {"message": "No shipments found", "shipped": 0}
@@ -372,11 +594,7 @@ def download_labels_for_shipped_orders(email: str = None, password: str = None,
     # Group by courier
     courier_shipments = {}
     for order in orders:
-        shipments = order.get("shipments", {})
-        if isinstance(shipments, dict):
-            shipments = [shipments]
-        
-        for shipment in shipments:
+        for shipment in get_order_shipments(order):
             courier = shipment.get("courier", "Unknown")
             shipment_id = shipment.get("id")
             if shipment_id:
@@ -388,19 +606,15 @@ def download_labels_for_shipped_orders(email: str = None, password: str = None,
     label_files = []
     for courier, shipment_ids in courier_shipments.items():
         try:
-            label_url = api.get_label_url(shipment_ids)
-            if label_url:
-                response = requests.get(label_url)
-                if response.status_code == 200:
-                    filename = f"{datetime.now().strftime('%Y-%m-%d')}_{courier.replace(' ', '_')}_labels.pdf"
-                    filepath = os.path.join(output_dir, filename)
-                    with open(filepath, "wb") as f:
-                        f.write(response.content)
-                    label_files.append({
-                        "courier": courier,
-                        "count": len(shipment_ids),
-                        "file": filepath
-                    })
+            filename = f"{datetime.now().strftime('%Y-%m-%d')}_{courier.replace(' ', '_')}_labels.pdf"
+            filepath = os.path.join(output_dir, filename)
+            # Stream to disk so large label PDFs are never held in memory
+            if api.generate_label_to_file(shipment_ids, filepath):
+                label_files.append({
+                    "courier": courier,
+                    "count": len(shipment_ids),
+                    "file": filepath
+                })
         except Exception as e:
             print(f"Error downloading labels for {courier}: {e}")
     
@@ -416,7 +630,7 @@ if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
     
-    api = ShiprocketAPI()
+    api = ShiprocketAPI(cache_token=True)
     
     # Test authentication
     print("Authenticating...")